@@ -1,32 +1,70 @@
-from flask import Flask, request, jsonify, render_template, redirect, url_for
+from gevent import monkey
+monkey.patch_all()
+
+from flask import Flask, Response, request, render_template, redirect, url_for
+from flask.json.provider import JSONProvider
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from flask_caching import Cache
 from flask_cors import CORS
+from flask_compress import Compress
 import logging
 import os
+from functools import wraps
+import queue
+import threading
+from datetime import timedelta
+import msgspec
+import orjson
+import redis
 from config import config
 from models import SubdomainManager
 from security import SecurityManager, require_api_key, validate_request
 from dns_manager import DNSManager
 
+class OrjsonProvider(JSONProvider):
+    """JSON provider backed by orjson"""
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_UTC_Z).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 # Initialize Flask app
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 # Load configuration
 env = os.environ.get('FLASK_ENV', 'production')
 app.config.from_object(config[env])
 
+# Plain lookups for the request hot path
+BASE_DOMAINS = dict(app.config['BASE_DOMAINS'])
+VALID_TLDS = frozenset(BASE_DOMAINS)
+
 # Initialize extensions
 limiter = Limiter(
     app=app,
     key_func=get_remote_address,
     default_limits=[app.config['RATE_LIMIT']],
-    storage_uri="memory://"
+    strategy=app.config['RATELIMIT_STRATEGY'],
+    storage_uri=app.config['REDIS_URL'],
+    storage_options={'max_connections': app.config['REDIS_MAX_CONNECTIONS']},
+    in_memory_fallback_enabled=app.config['RATELIMIT_IN_MEMORY_FALLBACK_ENABLED'],
+    swallow_errors=app.config['RATELIMIT_SWALLOW_ERRORS']
 )
 
-cache = Cache(app)
+# Flask-Caching ignores CACHE_OPTIONS when given CACHE_REDIS_URL, so hand it
+# a pooled client directly
+cache = Cache(app, config={
+    'CACHE_REDIS_HOST': redis.Redis.from_url(
+        app.config['REDIS_URL'],
+        max_connections=app.config['REDIS_MAX_CONNECTIONS']
+    )
+})
 CORS(app, origins=app.config['CORS_ORIGINS'])
+Compress(app)
 
 # Initialize managers
 subdomain_manager = SubdomainManager()
@@ -40,6 +78,125 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# ==================== Background Jobs ====================
+
+dns_queue = queue.Queue()
+
+def dns_job(record):
+    """Build the DNS provisioning job for a subdomain record"""
+    return {
+        'subdomain': record['subdomain'],
+        'tld': record['tld'],
+        'created_at': record['created_at'],
+        'full_subdomain': f"{record['subdomain']}.{BASE_DOMAINS[record['tld']]}",
+        'target': record['target'],
+        'record_type': record['record_type']
+    }
+
+def requeue_stale_dns_jobs():
+    """Re-queue DNS jobs lost with a worker that exited before running them"""
+    stale_after = timedelta(seconds=app.config['DNS_PENDING_RETRY_AFTER'])
+    for record in subdomain_manager.claim_stale_pending_dns(stale_after):
+        if record['tld'] not in VALID_TLDS:
+            continue
+        logger.info(f"Retrying pending DNS record for {record['subdomain']}.{record['tld']}")
+        dns_queue.put(dns_job(record))
+
+def dns_worker():
+    """Provision queued DNS records off the request path"""
+    while True:
+        try:
+            job = dns_queue.get(timeout=app.config['DNS_PENDING_RETRY_AFTER'])
+        except queue.Empty:
+            try:
+                requeue_stale_dns_jobs()
+            except Exception as e:
+                logger.error(f"DNS requeue error: {str(e)}")
+            continue
+        
+        try:
+            record_id = dns_manager.create_dns_record(
+                job['full_subdomain'], job['tld'], job['target'], job['record_type']
+            )
+            if record_id:
+                logger.info(f"DNS record created for {job['full_subdomain']}")
+            
+            update = {
+                'dns_record_id': record_id,
+                'dns_status': 'active' if record_id else 'failed'
+            }
+            updated = subdomain_manager.update_subdomain(
+                job['subdomain'], job['tld'], update, created_at=job['created_at']
+            )
+            if not updated and record_id:
+                # Subdomain was deleted (or deleted and re-created) while queued
+                dns_manager.delete_dns_record(job['tld'], record_id)
+        except Exception as e:
+            logger.error(f"DNS worker error: {str(e)}")
+        finally:
+            dns_queue.task_done()
+
+threading.Thread(target=dns_worker, name='dns-worker', daemon=True).start()
+
+try:
+    requeue_stale_dns_jobs()
+except Exception as e:
+    logger.error(f"DNS requeue error: {str(e)}")
+
+# ==================== Helpers ====================
+
+MSGPACK_MIMETYPE = 'application/msgpack'
+
+def wants_msgpack() -> bool:
+    """Check whether the client prefers a MessagePack response"""
+    return request.accept_mimetypes.best_match(['application/json', MSGPACK_MIMETYPE]) == MSGPACK_MIMETYPE
+
+def respond(data, status=200, etag=None):
+    """Serialize data as JSON or, if the client asks for it, MessagePack"""
+    if wants_msgpack():
+        response = Response(msgspec.msgpack.encode(data), status, mimetype=MSGPACK_MIMETYPE)
+    else:
+        response = app.json.response(data)
+        response.status_code = status
+    response.vary.add('Accept')
+    if etag:
+        response.set_etag(etag, weak=True)
+    return response
+
+def store_etag() -> str:
+    """Weak ETag for responses derived from the subdomain store"""
+    return f"{subdomain_manager.etag}-{'msgpack' if wants_msgpack() else 'json'}"
+
+def etag_matches(etag: str) -> bool:
+    """Check If-None-Match against etag, ignoring the ':<algorithm>' suffix
+    Flask-Compress appends to the ETags of compressed responses"""
+    if_none_match = request.if_none_match
+    if if_none_match.star_tag:
+        return True
+    
+    for tag in if_none_match.as_set(include_weak=True):
+        base, _, algorithm = tag.rpartition(':')
+        if tag == etag or (base == etag and algorithm in app.config['COMPRESS_ALGORITHM']):
+            return True
+    return False
+
+def etag_conditional(f):
+    """Decorator answering 304 Not Modified when If-None-Match matches the store"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        etag = store_etag()
+        if etag_matches(etag):
+            response = Response(status=304)
+            response.vary.add('Accept')
+            response.set_etag(etag, weak=True)
+            return response
+        return f(*args, **kwargs)
+    return decorated_function
+
+def negotiated_cache_key() -> str:
+    """Cache key for views whose body depends on the Accept header"""
+    return f"view/{request.path}/{'msgpack' if wants_msgpack() else 'json'}"
+
 # ==================== Routes ====================
 
 @app.route('/')
@@ -51,42 +208,45 @@ def index():
                          base_domains=app.config['BASE_DOMAINS'])
 
 @app.route('/health')
+@limiter.exempt
 def health_check():
     """Health check endpoint"""
-    return jsonify({
+    return respond({
         'status': 'healthy',
         'service': 'Ntando Store Subdomain Manager',
         'version': '1.0.0'
-    }), 200
+    }, 200)
 
 # ==================== API Routes ====================
 
 @app.route('/api/subdomains', methods=['GET'])
 @limiter.limit("30 per minute")
+@etag_conditional
 def get_subdomains():
     """Get all subdomains"""
     try:
+        # Taken before reading so a concurrent write can only make it stale
+        etag = store_etag()
         tld = request.args.get('tld')
         query = request.args.get('q')
         
         if query:
             subdomains = subdomain_manager.search_subdomains(query)
         else:
-            all_subdomains = subdomain_manager.get_all_subdomains()
             if tld:
-                subdomains = [v for k, v in all_subdomains.items() if v['tld'] == tld]
+                subdomains = subdomain_manager.get_by_tld(tld)
             else:
-                subdomains = list(all_subdomains.values())
+                subdomains = list(subdomain_manager.get_all_subdomains().values())
         
-        return jsonify({
+        return respond({
             'success': True,
             'count': len(subdomains),
             'subdomains': subdomains
-        }), 200
+        }, 200, etag=etag)
         
     except Exception as e:
         logger.error(f"Error fetching subdomains: {str(e)}")
-        return jsonify({'success': False, 'error': 'Internal server error'}), 500
+        return respond({'success': False, 'error': 'Internal server error'}, 500)
 
 @app.route('/api/subdomains/<tld>/<subdomain>', methods=['GET'])
 @limiter.limit("60 per minute")
@@ -97,13 +257,13 @@ def get_subdomain(tld, subdomain):
         result = subdomain_manager.get_subdomain(subdomain, tld)
         
         if result:
-            return jsonify({'success': True, 'subdomain': result}), 200
+            return respond({'success': True, 'subdomain': result}, 200)
         else:
-            return jsonify({'success': False, 'error': 'Subdomain not found'}), 404
+            return respond({'success': False, 'error': 'Subdomain not found'}, 404)
             
     except Exception as e:
         logger.error(f"Error fetching subdomain: {str(e)}")
-        return jsonify({'success': False, 'error': 'Internal server error'}), 500
+        return respond({'success': False, 'error': 'Internal server error'}, 500)
 
 @app.route('/api/subdomains', methods=['POST'])
 @limiter.limit("10 per minute")
@@ -117,58 +277,58 @@ def create_subdomain():
         subdomain = data.get('subdomain')
         tld = data.get('tld')
         
-        if not subdomain or not tld:
-            return jsonify({'success': False, 'error': 'Subdomain and TLD required'}), 400
+        if not isinstance(subdomain, str) or not isinstance(tld, str) or not subdomain or not tld:
+            return respond({'success': False, 'error': 'Subdomain and TLD required'}, 400)
         
         # Sanitize and validate
-        subdomain = security_manager.sanitize_subdomain(subdomain)
+        subdomain = security_manager.normalize_subdomain(subdomain)
         
-        if not security_manager.validate_subdomain(subdomain):
-            return jsonify({'success': False, 'error': 'Invalid subdomain format'}), 400
+        if subdomain is None:
+            return respond({'success': False, 'error': 'Invalid subdomain format'}, 400)
         
-        if tld not in app.config['BASE_DOMAINS']:
-            return jsonify({'success': False, 'error': 'Invalid TLD'}), 400
+        if tld not in VALID_TLDS:
+            return respond({'success': False, 'error': 'Invalid TLD'}, 400)
         
         # Check if subdomain already exists
         if subdomain_manager.get_subdomain(subdomain, tld):
-            return jsonify({'success': False, 'error': 'Subdomain already exists'}), 409
+            return respond({'success': False, 'error': 'Subdomain already exists'}, 409)
         
         # Prepare configuration
         target_ip = data.get('target', '0.0.0.0')
         record_type = data.get('record_type', 'A')
         ssl_enabled = data.get('ssl_enabled', True)
         
-        # Create DNS record if auto_dns is enabled
-        dns_record_id = None
+        # DNS records are provisioned in the background if auto_dns is enabled
         config = subdomain_manager.get_config()
-        
-        if config.get('auto_dns', True):
-            full_subdomain = f"{subdomain}.{app.config['BASE_DOMAINS'][tld]}"
-            if dns_manager.create_dns_record(full_subdomain, tld, target_ip, record_type):
-                logger.info(f"DNS record created for {full_subdomain}")
+        auto_dns = config.get('auto_dns', True)
         
         # Create subdomain in database
         subdomain_config = {
             'target': target_ip,
             'record_type': record_type,
             'ssl_enabled': ssl_enabled,
-            'dns_record_id': dns_record_id,
+            'dns_record_id': None,
+            'dns_status': 'pending' if auto_dns else None,
             'metadata': data.get('metadata', {})
         }
         
         if subdomain_manager.create_subdomain(subdomain, tld, subdomain_config):
             result = subdomain_manager.get_subdomain(subdomain, tld)
-            return jsonify({
+            
+            if auto_dns:
+                dns_queue.put(dns_job(result))
+            
+            return respond({
                 'success': True,
                 'message': 'Subdomain created successfully',
                 'subdomain': result
-            }), 201
+            }, 202 if auto_dns else 201)
         else:
-            return jsonify({'success': False, 'error': 'Failed to create subdomain'}), 500
+            return respond({'success': False, 'error': 'Failed to create subdomain'}, 500)
             
     except Exception as e:
         logger.error(f"Error creating subdomain: {str(e)}")
-        return jsonify({'success': False, 'error': 'Internal server error'}), 500
+        return respond({'success': False, 'error': 'Internal server error'}, 500)
 
 @app.route('/api/subdomains/<tld>/<subdomain>', methods=['PUT'])
 @limiter.limit("20 per minute")
@@ -181,7 +341,7 @@ def update_subdomain(tld, subdomain):
         
         # Check if subdomain exists
         if not subdomain_manager.get_subdomain(subdomain, tld):
-            return jsonify({'success': False, 'error': 'Subdomain not found'}), 404
+            return respond({'success': False, 'error': 'Subdomain not found'}, 404)
         
         # Update configuration
         update_config = {}
@@ -190,23 +350,25 @@ def update_subdomain(tld, subdomain):
         if 'ssl_enabled' in data:
             update_config['ssl_enabled'] = data['ssl_enabled']
         if 'status' in data:
+            if not isinstance(data['status'], str):
+                return respond({'success': False, 'error': 'Invalid status'}, 400)
             update_config['status'] = data['status']
         if 'metadata' in data:
             update_config['metadata'] = data['metadata']
         
         if subdomain_manager.update_subdomain(subdomain, tld, update_config):
             result = subdomain_manager.get_subdomain(subdomain, tld)
-            return jsonify({
+            return respond({
                 'success': True,
                 'message': 'Subdomain updated successfully',
                 'subdomain': result
-            }), 200
+            }, 200)
         else:
-            return jsonify({'success': False, 'error': 'Failed to update subdomain'}), 500
+            return respond({'success': False, 'error': 'Failed to update subdomain'}, 500)
             
     except Exception as e:
         logger.error(f"Error updating subdomain: {str(e)}")
-        return jsonify({'success': False, 'error': 'Internal server error'}), 500
+        return respond({'success': False, 'error': 'Internal server error'}, 500)
 
 @app.route('/api/subdomains/<tld>/<subdomain>', methods=['DELETE'])
 @limiter.limit("10 per minute")
@@ -218,7 +380,7 @@ def delete_subdomain(tld, subdomain):
         # Check if subdomain exists
         subdomain_data = subdomain_manager.get_subdomain(subdomain, tld)
         if not subdomain_data:
-            return jsonify({'success': False, 'error': 'Subdomain not found'}), 404
+            return respond({'success': False, 'error': 'Subdomain not found'}, 404)
         
         # Delete DNS record if exists
         if subdomain_data.get('dns_record_id'):
@@ -226,75 +388,66 @@ def delete_subdomain(tld, subdomain):
         
         # Delete from database
         if subdomain_manager.delete_subdomain(subdomain, tld):
-            return jsonify({
+            return respond({
                 'success': True,
                 'message': 'Subdomain deleted successfully'
-            }), 200
+            }, 200)
         else:
-            return jsonify({'success': False, 'error': 'Failed to delete subdomain'}), 500
+            return respond({'success': False, 'error': 'Failed to delete subdomain'}, 500)
             
     except Exception as e:
         logger.error(f"Error deleting subdomain: {str(e)}")
-        return jsonify({'success': False, 'error': 'Internal server error'}), 500
+        return respond({'success': False, 'error': 'Internal server error'}, 500)
 
 @app.route('/api/config', methods=['GET'])
 def get_config():
     """Get configuration"""
     try:
         config = subdomain_manager.get_config()
-        return jsonify({'success': True, 'config': config}), 200
+        return respond({'success': True, 'config': config}, 200)
     except Exception as e:
         logger.error(f"Error fetching config: {str(e)}")
-        return jsonify({'success': False, 'error': 'Internal server error'}), 500
+        return respond({'success': False, 'error': 'Internal server error'}, 500)
 
 @app.route('/api/stats', methods=['GET'])
-@cache.cached(timeout=60)
+@etag_conditional
+@cache.cached(timeout=60, key_prefix=negotiated_cache_key)
 def get_stats():
     """Get statistics"""
     try:
-        subdomains = subdomain_manager.get_all_subdomains()
-        
-        stats = {
-            'total_subdomains': len(subdomains),
-            'by_tld': {},
-            'by_status': {},
-            'ssl_enabled': 0
-        }
-        
-        for subdomain_data in subdomains.values():
-            tld = subdomain_data['tld']
-            status = subdomain_data.get('status', 'unknown')
-            
-            stats['by_tld'][tld] = stats['by_tld'].get(tld, 0) + 1
-            stats['by_status'][status] = stats['by_status'].get(status, 0) + 1
-            
-            if subdomain_data.get('ssl_enabled'):
-                stats['ssl_enabled'] += 1
+        etag = store_etag()
+        stats = subdomain_manager.get_stats()
         
-        return jsonify({'success': True, 'stats': stats}), 200
+        return respond({'success': True, 'stats': stats}, 200, etag=etag)
         
     except Exception as e:
         logger.error(f"Error fetching stats: {str(e)}")
-        return jsonify({'success': False, 'error': 'Internal server error'}), 500
+        return respond({'success': False, 'error': 'Internal server error'}, 500)
 
 # ==================== Error Handlers ====================
 
 @app.errorhandler(404)
 def not_found(error):
-    return jsonify({'success': False, 'error': 'Resource not found'}), 404
+    return respond({'success': False, 'error': 'Resource not found'}, 404)
 
 @app.errorhandler(429)
 def ratelimit_handler(e):
-    return jsonify({'success': False, 'error': 'Rate limit exceeded'}), 429
+    return respond({'success': False, 'error': 'Rate limit exceeded'}, 429)
 
 @app.errorhandler(500)
 def internal_error(error):
     logger.error(f"Internal server error: {str(error)}")
-    return jsonify({'success': False, 'error': 'Internal server error'}), 500
+    return respond({'success': False, 'error': 'Internal server error'}, 500)
 
 # ==================== Main ====================
 
 if __name__ == '__main__':
+    if env != 'development':
+        # Production is served by gunicorn (see gunicorn.conf.py)
+        logger.error(f"The dev server only runs with FLASK_ENV=development (got '{env}'); "
+                     "start with: gunicorn -c gunicorn.conf.py app:app")
+        raise SystemExit(1)
+    
     app.run(
         host=app.config['HOST'],
         port=app.config['PORT'],
@@ -15,21 +15,34 @@ class Config:
         'id': os.environ.get('BASE_DOMAIN_ID', 'ntandostore.id')
     }
     
+    # Redis (shared by the rate limiter and cache across workers)
+    REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+    REDIS_MAX_CONNECTIONS = int(os.environ.get('REDIS_MAX_CONNECTIONS', 20))
+    
     # Security
     RATE_LIMIT = "100 per minute"
+    RATELIMIT_STRATEGY = "moving-window"
+    RATELIMIT_IN_MEMORY_FALLBACK_ENABLED = True  # Per-process limits while Redis is down
+    RATELIMIT_SWALLOW_ERRORS = True
     SESSION_COOKIE_SECURE = True
     SESSION_COOKIE_HTTPONLY = True
     SESSION_COOKIE_SAMESITE = 'Lax'
     PERMANENT_SESSION_LIFETIME = timedelta(hours=24)
     
     # Caching
-    CACHE_TYPE = "SimpleCache"  # Use Redis in production
+    CACHE_TYPE = "RedisCache"  # Pooled client is built from REDIS_URL in app.py
     CACHE_DEFAULT_TIMEOUT = 300
     
+    # Compression
+    COMPRESS_ALGORITHM = ['br', 'gzip']
+    COMPRESS_MIN_SIZE = 500
+    COMPRESS_BR_LEVEL = 4
+    
     # CORS
     CORS_ORIGINS = os.environ.get('CORS_ORIGINS', '*').split(',')
     
     # DNS Configuration
+    DNS_PENDING_RETRY_AFTER = int(os.environ.get('DNS_PENDING_RETRY_AFTER', 300))  # seconds
     DNS_PROVIDERS = {
         'cloudflare': {
             'api_token': os.environ.get('CLOUDFLARE_API_TOKEN'),
@@ -52,16 +65,22 @@ class ProductionConfig(Config):
     """Production configuration"""
     DEBUG = False
     TESTING = False
-    CACHE_TYPE = "RedisCache"
-    CACHE_REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
 
 class DevelopmentConfig(Config):
     """Development configuration"""
     DEBUG = True
     TESTING = True
 
+class TestingConfig(Config):
+    """Testing configuration (no Redis required)"""
+    DEBUG = False
+    TESTING = True
+    CACHE_TYPE = "SimpleCache"
+    RATELIMIT_ENABLED = False
+
 config = {
     'development': DevelopmentConfig,
+    'testing': TestingConfig,
     'production': ProductionConfig,
     'default': ProductionConfig
 }
@@ -1,19 +1,39 @@
 import requests
+from requests.adapters import HTTPAdapter
 import json
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List, Optional
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Concurrent Cloudflare requests for bulk operations and pagination
+BULK_POOL_SIZE = 10
+DNS_RECORDS_PER_PAGE = 100
+
 class DNSManager:
     """Manage DNS records across providers"""
     
     def __init__(self, config):
         self.config = config
         self.providers = config.get('DNS_PROVIDERS', {})
+        self.session = self._create_session()
+        self.executor = ThreadPoolExecutor(max_workers=BULK_POOL_SIZE, thread_name_prefix='dns-bulk')
+    
+    def _create_session(self) -> requests.Session:
+        """Create a keep-alive session for the Cloudflare API"""
+        api_token = self.providers.get('cloudflare', {}).get('api_token')
+        
+        session = requests.Session()
+        session.headers.update({
+            'Authorization': f'Bearer {api_token}',
+            'Content-Type': 'application/json'
+        })
+        session.mount('https://', HTTPAdapter(pool_connections=10, pool_maxsize=20))
+        return session
     
-    def create_dns_record(self, subdomain: str, tld: str, target_ip: str, record_type: str = 'A') -> bool:
-        """Create DNS record in Cloudflare"""
+    def create_dns_record(self, subdomain: str, tld: str, target_ip: str, record_type: str = 'A') -> Optional[str]:
+        """Create DNS record in Cloudflare, returning the new record ID"""
         try:
             cloudflare = self.providers.get('cloudflare', {})
             api_token = cloudflare.get('api_token')
@@ -21,12 +41,7 @@ class DNSManager:
             
             if not api_token or not zone_id:
                 logger.warning(f"DNS provider not configured for {tld}")
-                return False
-            
-            headers = {
-                'Authorization': f'Bearer {api_token}',
-                'Content-Type': 'application/json'
-            }
+                return None
             
             data = {
                 'type': record_type,
@@ -37,18 +52,18 @@ class DNSManager:
             }
             
             url = f'https://api.cloudflare.com/client/v4/zones/{zone_id}/dns_records'
-            response = requests.post(url, headers=headers, json=data, timeout=10)
+            response = self.session.post(url, json=data, timeout=10)
             
             if response.status_code == 200:
                 logger.info(f"DNS record created: {subdomain}.{tld}")
-                return True
+                return response.json().get('result', {}).get('id')
             else:
                 logger.error(f"Failed to create DNS record: {response.text}")
-                return False
+                return None
                 
         except Exception as e:
             logger.error(f"DNS creation error: {str(e)}")
-            return False
+            return None
     
     def update_dns_record(self, subdomain: str, tld: str, target_ip: str, record_id: str) -> bool:
         """Update existing DNS record"""
@@ -60,11 +75,6 @@ class DNSManager:
             if not api_token or not zone_id:
                 return False
             
-            headers = {
-                'Authorization': f'Bearer {api_token}',
-                'Content-Type': 'application/json'
-            }
-            
             data = {
                 'type': 'A',
                 'name': subdomain,
@@ -74,7 +84,7 @@ class DNSManager:
             }
             
             url = f'https://api.cloudflare.com/client/v4/zones/{zone_id}/dns_records/{record_id}'
-            response = requests.put(url, headers=headers, json=data, timeout=10)
+            response = self.session.put(url, json=data, timeout=10)
             
             return response.status_code == 200
             
@@ -92,13 +102,8 @@ class DNSManager:
             if not api_token or not zone_id:
                 return False
             
-            headers = {
-                'Authorization': f'Bearer {api_token}',
-                'Content-Type': 'application/json'
-            }
-            
             url = f'https://api.cloudflare.com/client/v4/zones/{zone_id}/dns_records/{record_id}'
-            response = requests.delete(url, headers=headers, timeout=10)
+            response = self.session.delete(url, timeout=10)
             
             return response.status_code == 200
             
@@ -116,18 +121,40 @@ class DNSManager:
             if not api_token or not zone_id:
                 return []
             
-            headers = {
-                'Authorization': f'Bearer {api_token}',
-                'Content-Type': 'application/json'
-            }
-            
             url = f'https://api.cloudflare.com/client/v4/zones/{zone_id}/dns_records'
-            response = requests.get(url, headers=headers, timeout=10)
+            response = self._get_dns_page(url, 1)
             
-            if response.status_code == 200:
-                return response.json().get('result', [])
-            return []
+            if response.status_code != 200:
+                return []
+            
+            body = response.json()
+            records = body.get('result', [])
+            total_pages = body.get('result_info', {}).get('total_pages', 1)
+            
+            # Fetch remaining pages concurrently; a failed page is logged and
+            # skipped without discarding the others
+            futures = [self.executor.submit(self._get_dns_page, url, n) for n in range(2, total_pages + 1)]
+            for future in futures:
+                try:
+                    page = future.result()
+                    if page.status_code == 200:
+                        records.extend(page.json().get('result', []))
+                    else:
+                        logger.error(f"Failed to list DNS records page: {page.text}")
+                except Exception as e:
+                    logger.error(f"DNS list page error: {str(e)}")
+            
+            return records
             
         except Exception as e:
             logger.error(f"DNS list error: {str(e)}")
             return []
+    
+    def _get_dns_page(self, url: str, page: int) -> requests.Response:
+        """Fetch one page of DNS records"""
+        return self.session.get(url, params={'page': page, 'per_page': DNS_RECORDS_PER_PAGE}, timeout=10)
+    
+    def bulk_delete(self, tld: str, record_ids: List[str]) -> Dict[str, bool]:
+        """Delete many DNS records concurrently, returning success per record ID"""
+        results = self.executor.map(lambda record_id: self.delete_dns_record(tld, record_id), record_ids)
+        return dict(zip(record_ids, results))
@@ -0,0 +1,22 @@
+import multiprocessing
+import os
+
+# Server socket
+bind = f"{os.environ.get('HOST', '0.0.0.0')}:{os.environ.get('PORT', 10000)}"
+
+# Worker processes
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+worker_class = 'gevent'
+worker_connections = 1000
+keepalive = 5
+timeout = 30
+
+# Logging
+accesslog = '-'
+errorlog = '-'
+
+# Server hooks
+def worker_exit(server, worker):
+    """Flush debounced subdomain writes before the worker exits"""
+    from app import subdomain_manager
+    subdomain_manager.flush()
@@ -1,25 +1,72 @@
+import atexit
+import fcntl
 import json
+import logging
 import os
-from datetime import datetime
+import time
+import msgspec
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 from typing import Dict, List, Optional
 import threading
 
+logger = logging.getLogger(__name__)
+
+# Debounce window for coalescing subdomain writes to disk
+FLUSH_INTERVAL = 0.1
+
+def run_blocking(func, *args):
+    """Run blocking file I/O on a native thread when gevent has patched
+    threading, so it doesn't stall the event loop"""
+    try:
+        from gevent import get_hub, monkey
+    except ImportError:
+        return func(*args)
+    if monkey.is_module_patched('threading'):
+        return get_hub().threadpool.apply(func, args)
+    return func(*args)
+
+class StoreCorruptError(Exception):
+    """Raised when the subdomain store on disk can't be decoded"""
+
 class SubdomainManager:
-    """Manage subdomains from JSON files"""
+    """Manage subdomains stored in MessagePack files"""
     
     def __init__(self, domains_dir='domains'):
-        self.domains_dir = domains_dir
-        self.subdomains_file = os.path.join(domains_dir, 'subdomains.json')
-        self.config_file = os.path.join(domains_dir, 'domain_config.json')
-        self.lock = threading.Lock()
+        # Absolute, so the atexit flush still hits the right file if cwd changes
+        self.domains_dir = os.path.abspath(domains_dir)
+        self.subdomains_file = os.path.join(self.domains_dir, 'subdomains.msgpack')
+        self.legacy_subdomains_file = os.path.join(self.domains_dir, 'subdomains.json')
+        self.store_lock_file = os.path.join(self.domains_dir, 'subdomains.msgpack.lock')
+        self.dns_claim_lock_file = os.path.join(self.domains_dir, 'dns_claim.lock')
+        self.config_file = os.path.join(self.domains_dir, 'domain_config.json')
+        self.lock = threading.RLock()
+        self._write_lock = threading.Lock()
+        self._cache = None
+        self._cache_mtime = 0
+        self._version = 0
+        self._written_version = 0
+        self._pending = {}
+        self._by_tld = defaultdict(dict)
+        self._counts_by_tld = Counter()
+        self._counts_by_status = Counter()
+        self._ssl_count = 0
+        self._search_haystack = {}
+        self._dirty = threading.Event()
         self._ensure_files_exist()
+        
+        threading.Thread(target=self._flush_loop, name='subdomain-flush', daemon=True).start()
+        atexit.register(self.flush)
     
     def _ensure_files_exist(self):
         """Create domain files if they don't exist"""
         os.makedirs(self.domains_dir, exist_ok=True)
         
         if not os.path.exists(self.subdomains_file):
-            self._save_json(self.subdomains_file, {})
+            with self._store_file_lock():
+                if not os.path.exists(self.subdomains_file):
+                    self._migrate_legacy_subdomains()
         
         if not os.path.exists(self.config_file):
             default_config = {
@@ -38,20 +85,304 @@ class SubdomainManager:
         except (FileNotFoundError, json.JSONDecodeError):
             return {}
     
+    def _atomic_write(self, filepath, payload: bytes):
+        """Write to a temp file and rename it over filepath, so readers
+        never see a partially written file"""
+        tmp_path = f"{filepath}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(payload)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, filepath)
+        except Exception:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+    
     def _save_json(self, filepath, data):
         """Save JSON file"""
-        with open(filepath, 'w') as f:
-            json.dump(data, f, indent=2)
+        self._atomic_write(filepath, json.dumps(data, indent=2).encode())
+    
+    def _load_msgpack(self, filepath):
+        """Load MessagePack file"""
+        try:
+            with open(filepath, 'rb') as f:
+                return msgspec.msgpack.decode(f.read())
+        except FileNotFoundError:
+            return {}
+        except msgspec.DecodeError as e:
+            # Never hand back an empty store that would then be flushed
+            # over the only copy of the data
+            logger.error(f"Corrupt MessagePack file {filepath}: {str(e)}")
+            raise StoreCorruptError(filepath) from e
+    
+    def _save_msgpack(self, filepath, data):
+        """Save MessagePack file"""
+        self._atomic_write(filepath, msgspec.msgpack.encode(data))
+    
+    def _migrate_legacy_subdomains(self):
+        """One-shot migration of subdomains.json into the MessagePack store"""
+        try:
+            with open(self.legacy_subdomains_file, 'r') as f:
+                subdomains = json.load(f)
+        except FileNotFoundError:
+            subdomains = {}
+        except json.JSONDecodeError as e:
+            # Migrating {} would leave the legacy file unread from then on
+            logger.error(f"Corrupt JSON file {self.legacy_subdomains_file}: {str(e)}")
+            raise StoreCorruptError(self.legacy_subdomains_file) from e
+        self._save_msgpack(self.subdomains_file, subdomains)
+    
+    def _load_subdomains(self) -> Dict:
+        """Load subdomains, reparsing the file only when its mtime changes"""
+        try:
+            mtime = os.stat(self.subdomains_file).st_mtime_ns
+        except FileNotFoundError:
+            mtime = 0
+        
+        if self._cache is None or mtime != self._cache_mtime:
+            with self.lock:
+                # Our own pending writes also move the mtime; only reload
+                # once they have been flushed and the file still differs
+                if self._cache is None or (
+                    self._written_version == self._version and mtime != self._cache_mtime
+                ):
+                    subdomains = self._load_msgpack(self.subdomains_file)
+                    self._build_indexes(subdomains)
+                    self._cache = subdomains
+                    self._cache_mtime = mtime
+        return self._cache
+    
+    def _build_indexes(self, subdomains: Dict):
+        """Rebuild the per-TLD index and stats counters for subdomains"""
+        fields = {}
+        for key, value in subdomains.items():
+            fields[key] = self._indexed_fields(value)
+            if fields[key] != (value.get('tld'), value.get('status', 'unknown')):
+                # Older stores may hold e.g. status: null; index it as 'unknown'
+                # rather than failing the whole store
+                logger.warning(f"Subdomain {key} has a non-string tld/status; indexing it as 'unknown'")
+        
+        # Build everything first so a failure leaves the old indexes intact
+        counts_by_tld = Counter(tld for tld, _ in fields.values())
+        counts_by_status = Counter(status for _, status in fields.values())
+        ssl_count = sum(1 for v in subdomains.values() if v.get('ssl_enabled'))
+        
+        by_tld = defaultdict(dict)
+        for key, value in subdomains.items():
+            by_tld[fields[key][0]][key] = value
+        
+        search_haystack = {key: self._haystack(key, value) for key, value in subdomains.items()}
+        
+        self._counts_by_tld = counts_by_tld
+        self._counts_by_status = counts_by_status
+        self._ssl_count = ssl_count
+        self._by_tld = by_tld
+        self._search_haystack = search_haystack
+    
+    @staticmethod
+    def _indexed_fields(value: Dict) -> tuple:
+        """The (tld, status) a record is indexed under, with anything that
+        isn't a string mapped to 'unknown'"""
+        tld = value.get('tld')
+        status = value.get('status', 'unknown')
+        return (
+            tld if isinstance(tld, str) else 'unknown',
+            status if isinstance(status, str) else 'unknown'
+        )
+    
+    @staticmethod
+    def _validate_record(value: Dict):
+        """Reject records whose indexed fields aren't strings; only used on
+        the create/update write paths"""
+        if not isinstance(value.get('tld'), str):
+            raise ValueError("Subdomain tld must be a string")
+        if not isinstance(value.get('status', 'unknown'), str):
+            raise ValueError("Subdomain status must be a string")
+    
+    @staticmethod
+    def _haystack(key: str, value: Dict) -> str:
+        """Lowercased text that search queries are matched against: the key
+        plus every field value, nested metadata included"""
+        parts = [key]
+        stack = [value]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, dict):
+                stack.extend(item.values())
+            elif isinstance(item, (list, tuple)):
+                stack.extend(item)
+            else:
+                parts.append(str(item))
+        return ' '.join(parts).lower()
+    
+    def _index_add(self, key: str, value: Dict):
+        """Add a record to the secondary indexes"""
+        tld, status = self._indexed_fields(value)
+        self._by_tld[tld][key] = value
+        self._counts_by_tld[tld] += 1
+        self._counts_by_status[status] += 1
+        if value.get('ssl_enabled'):
+            self._ssl_count += 1
+        self._search_haystack[key] = self._haystack(key, value)
+    
+    def _index_remove(self, key: str, value: Dict):
+        """Remove a record from the secondary indexes"""
+        tld, status = self._indexed_fields(value)
+        
+        self._by_tld[tld].pop(key, None)
+        if not self._by_tld[tld]:
+            del self._by_tld[tld]
+        
+        self._counts_by_tld[tld] -= 1
+        if self._counts_by_tld[tld] <= 0:
+            del self._counts_by_tld[tld]
+        
+        self._counts_by_status[status] -= 1
+        if self._counts_by_status[status] <= 0:
+            del self._counts_by_status[status]
+        
+        if value.get('ssl_enabled'):
+            self._ssl_count -= 1
+        self._search_haystack.pop(key, None)
+    
+    @contextmanager
+    def _store_file_lock(self):
+        """Exclusive lock on the store file, shared by every worker process"""
+        with open(self.store_lock_file, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+    
+    def _mark_dirty(self, key: str, record: Optional[Dict]):
+        """Schedule a write-back of one record (None deletes it); must be
+        called with self.lock held"""
+        self._pending[key] = record
+        self._version += 1
+        self._dirty.set()
+    
+    def flush(self):
+        """Merge pending subdomain changes into the store on disk now
+        
+        Other worker processes write the same file, so if it changed since
+        we last read it, pending changes are applied on top of a fresh read
+        under an exclusive file lock rather than overwriting it with this
+        process's snapshot.
+        """
+        with self._write_lock:
+            with self.lock:
+                if not self._pending:
+                    return
+                # Copy so later in-place edits can't race the merge below
+                pending = msgspec.msgpack.decode(msgspec.msgpack.encode(self._pending))
+                self._pending = {}
+                version = self._version
+                payload = msgspec.msgpack.encode(self._cache)
+                expected_mtime = self._cache_mtime
+            
+            try:
+                mtime, merged = run_blocking(self._merge_and_write, payload, expected_mtime, pending)
+            except Exception:
+                with self.lock:
+                    # Keep the changes for a retry unless they've been superseded
+                    for key, record in pending.items():
+                        self._pending.setdefault(key, record)
+                    self._dirty.set()
+                raise
+            
+            with self.lock:
+                self._written_version = version
+                if merged is None:
+                    # Nobody else touched the file: cache and indexes are current
+                    self._cache_mtime = mtime
+                    return
+                
+                # Adopt the merged store, re-applying changes made meanwhile
+                for key, record in self._pending.items():
+                    if record is None:
+                        merged.pop(key, None)
+                    else:
+                        merged[key] = record
+                self._build_indexes(merged)
+                self._cache = merged
+                self._cache_mtime = mtime
+    
+    def _merge_and_write(self, payload: bytes, expected_mtime: int, pending: Dict) -> tuple:
+        """Write the store under the file lock, returning (mtime, merged)
+        
+        If the file is unchanged since this process last read or wrote it,
+        payload (our own cache) is written as is and merged is None.
+        Otherwise pending is applied on top of the file's contents and the
+        merged store is returned. Runs on a native thread under gevent, so
+        it must not touch self.lock.
+        """
+        with self._store_file_lock():
+            try:
+                disk_mtime = os.stat(self.subdomains_file).st_mtime_ns
+            except FileNotFoundError:
+                disk_mtime = 0
+            
+            merged = None
+            if disk_mtime != expected_mtime:
+                merged = self._load_msgpack(self.subdomains_file)
+                for key, record in pending.items():
+                    if record is None:
+                        merged.pop(key, None)
+                    else:
+                        merged[key] = record
+                payload = msgspec.msgpack.encode(merged)
+            
+            self._atomic_write(self.subdomains_file, payload)
+            return os.stat(self.subdomains_file).st_mtime_ns, merged
+    
+    def _flush_loop(self):
+        """Coalesce bursts of writes into one file rewrite per FLUSH_INTERVAL"""
+        while True:
+            self._dirty.wait()
+            time.sleep(FLUSH_INTERVAL)
+            self._dirty.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Subdomain flush error: {str(e)}")
+    
+    @property
+    def etag(self) -> str:
+        """Tag identifying the current store contents"""
+        self._load_subdomains()
+        if self._written_version == self._version:
+            # Everything is on disk, so the file mtime alone identifies the data
+            return str(self._cache_mtime)
+        # Unflushed changes are only visible in this process
+        return f"{self._cache_mtime}-{os.getpid()}-{self._version}"
     
     def get_all_subdomains(self) -> Dict:
         """Get all subdomains"""
-        return self._load_json(self.subdomains_file)
+        return self._load_subdomains()
     
     def get_subdomain(self, subdomain: str, tld: str) -> Optional[Dict]:
         """Get specific subdomain"""
-        subdomains = self.get_all_subdomains()
-        key = f"{subdomain}.{tld}"
-        return subdomains.get(key)
+        return self._load_subdomains().get(f"{subdomain}.{tld}")
+    
+    def get_by_tld(self, tld: str) -> List[Dict]:
+        """Get all subdomains under a TLD"""
+        self._load_subdomains()
+        return list(self._by_tld.get(tld, {}).values())
+    
+    def get_stats(self) -> Dict:
+        """Get subdomain statistics from the incremental counters"""
+        subdomains = self._load_subdomains()
+        return {
+            'total_subdomains': len(subdomains),
+            'by_tld': dict(self._counts_by_tld),
+            'by_status': dict(self._counts_by_status),
+            'ssl_enabled': self._ssl_count
+        }
     
     def create_subdomain(self, subdomain: str, tld: str, config: Dict) -> bool:
         """Create new subdomain"""
@@ -62,7 +393,7 @@ class SubdomainManager:
             if key in subdomains:
                 return False
             
-            subdomains[key] = {
+            record = {
                 'subdomain': subdomain,
                 'tld': tld,
                 'target': config.get('target', '0.0.0.0'),
@@ -72,25 +403,40 @@ class SubdomainManager:
                 'updated_at': datetime.utcnow().isoformat(),
                 'status': 'active',
                 'dns_record_id': config.get('dns_record_id'),
+                'dns_status': config.get('dns_status'),
                 'metadata': config.get('metadata', {})
             }
+            self._validate_record(record)
+            
+            subdomains[key] = record
+            self._index_add(key, record)
             
-            self._save_json(self.subdomains_file, subdomains)
+            self._mark_dirty(key, record)
             return True
     
-    def update_subdomain(self, subdomain: str, tld: str, config: Dict) -> bool:
-        """Update subdomain"""
+    def update_subdomain(self, subdomain: str, tld: str, config: Dict,
+                         created_at: Optional[str] = None) -> bool:
+        """Update subdomain; if created_at is given, only while the stored
+        record is still the one created at that time"""
         with self.lock:
             subdomains = self.get_all_subdomains()
             key = f"{subdomain}.{tld}"
             
             if key not in subdomains:
                 return False
+            if created_at is not None and subdomains[key].get('created_at') != created_at:
+                return False
             
-            subdomains[key].update(config)
-            subdomains[key]['updated_at'] = datetime.utcnow().isoformat()
+            # Validate the incoming fields before touching the cache or indexes;
+            # legacy bad values already in the record are left to the indexes
+            self._validate_record({**config, 'tld': tld})
+            record = {**subdomains[key], **config, 'updated_at': datetime.utcnow().isoformat()}
             
-            self._save_json(self.subdomains_file, subdomains)
+            self._index_remove(key, subdomains[key])
+            subdomains[key] = record
+            self._index_add(key, record)
+            
+            self._mark_dirty(key, record)
             return True
     
     def delete_subdomain(self, subdomain: str, tld: str) -> bool:
@@ -102,20 +448,43 @@ class SubdomainManager:
             if key not in subdomains:
                 return False
             
-            del subdomains[key]
-            self._save_json(self.subdomains_file, subdomains)
+            self._index_remove(key, subdomains.pop(key))
+            self._mark_dirty(key, None)
             return True
     
+    def claim_stale_pending_dns(self, older_than: timedelta) -> List[Dict]:
+        """Claim records stuck at dns_status 'pending' for longer than
+        older_than, e.g. because the worker holding their DNS job exited
+        
+        Claimed records get a fresh updated_at, written to disk before the
+        claim lock is released, so other workers don't claim them again.
+        Returns [] if another worker is claiming right now.
+        """
+        with open(self.dns_claim_lock_file, 'a') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return []
+            try:
+                cutoff = (datetime.utcnow() - older_than).isoformat()
+                stale = [
+                    value for value in self.get_all_subdomains().values()
+                    if value.get('dns_status') == 'pending' and str(value.get('updated_at') or '') < cutoff
+                ]
+                claimed = []
+                for value in stale:
+                    if self.update_subdomain(value['subdomain'], value['tld'], {}, created_at=value.get('created_at')):
+                        claimed.append(self.get_subdomain(value['subdomain'], value['tld']))
+                self.flush()
+                return claimed
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+    
     def search_subdomains(self, query: str) -> List[Dict]:
         """Search subdomains"""
-        subdomains = self.get_all_subdomains()
-        results = []
-        
-        for key, value in subdomains.items():
-            if query.lower() in key.lower() or query.lower() in str(value).lower():
-                results.append(value)
-        
-        return results
+        subdomains = self._load_subdomains()
+        query = query.lower()
+        return [subdomains[key] for key, haystack in self._search_haystack.items() if query in haystack]
     
     def get_config(self) -> Dict:
         """Get domain configuration"""
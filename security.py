@@ -2,11 +2,25 @@ import hashlib
 import hmac
 import secrets
 import re
+import threading
+import time
 from functools import wraps
 from flask import request, jsonify, current_app
 import jwt
 from datetime import datetime, timedelta
 
+# RFC 1123 label
+_VALIDATE = re.compile(r'^[a-z0-9]([a-z0-9\-]{0,61}[a-z0-9])?$')
+
+# Bytes stripped by sanitize_subdomain (everything except a-z, 0-9 and hyphen)
+_ALLOWED_BYTES = b'abcdefghijklmnopqrstuvwxyz0123456789-'
+_DISALLOWED_BYTES = bytes(c for c in range(256) if c not in _ALLOWED_BYTES)
+
+# Verified JWT payloads, keyed by a hash of the secret and token
+_TOKEN_CACHE_SIZE = 4096
+_token_cache = {}
+_token_cache_lock = threading.Lock()
+
 class SecurityManager:
     """Advanced security manager"""
     
@@ -23,19 +37,40 @@ class SecurityManager:
     @staticmethod
     def verify_token(token):
         """Verify JWT token"""
+        secret = current_app.config['SECRET_KEY']
+        key = hashlib.sha1(f"{secret}:{token}".encode()).digest()
+        now = time.time()
+        
+        cached = _token_cache.get(key)
+        if cached and cached[0] > now:
+            return cached[1]
+        
         try:
-            payload = jwt.decode(token, current_app.config['SECRET_KEY'], algorithms=['HS256'])
+            payload = jwt.decode(token, secret, algorithms=['HS256'])
+            SecurityManager._cache_token(key, payload.get('exp', float('inf')), payload['data'], now)
             return payload['data']
         except jwt.ExpiredSignatureError:
             return None
         except jwt.InvalidTokenError:
             return None
     
+    @staticmethod
+    def _cache_token(key, exp, data, now):
+        """Remember a verified token payload until it expires"""
+        with _token_cache_lock:
+            if len(_token_cache) >= _TOKEN_CACHE_SIZE:
+                for stale in [k for k, (e, _) in _token_cache.items() if e <= now]:
+                    del _token_cache[stale]
+            if len(_token_cache) >= _TOKEN_CACHE_SIZE:
+                # Still full: evict the oldest entry
+                del _token_cache[next(iter(_token_cache))]
+            _token_cache[key] = (exp, data)
+    
     @staticmethod
     def sanitize_subdomain(subdomain):
         """Sanitize subdomain input"""
         # Remove any dangerous characters
-        subdomain = re.sub(r'[^a-z0-9\-]', '', subdomain.lower())
+        subdomain = subdomain.lower().encode('ascii', 'ignore').translate(None, _DISALLOWED_BYTES).decode('ascii')
         # Ensure it doesn't start or end with hyphen
         subdomain = subdomain.strip('-')
         # Limit length
@@ -48,8 +83,17 @@ class SecurityManager:
         if not subdomain or len(subdomain) < 1 or len(subdomain) > 63:
             return False
         # RFC 1123 compliant
-        pattern = r'^[a-z0-9]([a-z0-9\-]{0,61}[a-z0-9])?$'
-        return bool(re.match(pattern, subdomain))
+        return _VALIDATE.match(subdomain) is not None
+    
+    @staticmethod
+    def normalize_subdomain(subdomain):
+        """Sanitize and validate subdomain in one step, returning None if invalid"""
+        subdomain = SecurityManager.sanitize_subdomain(subdomain)
+        # Sanitized labels are already [a-z0-9-]{0,63} without a leading
+        # hyphen, so RFC 1123 only needs a non-empty label not ending in one
+        if subdomain and subdomain[-1] != '-':
+            return subdomain
+        return None
     
     @staticmethod
     def generate_api_key():
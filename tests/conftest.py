@@ -0,0 +1,30 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture(scope='session')
+def app_module(tmp_path_factory):
+    """The app module, imported with the testing config
+
+    app.py builds its SubdomainManager from ./domains at import time, so
+    the import runs from a throwaway directory; cwd and FLASK_ENV are
+    restored afterwards.
+    """
+    with pytest.MonkeyPatch.context() as mp:
+        mp.chdir(tmp_path_factory.mktemp('import'))
+        mp.setenv('FLASK_ENV', 'testing')
+        import app
+    return app
+
+
+@pytest.fixture
+def client(app_module, tmp_path, monkeypatch):
+    """Test client backed by an empty store of its own"""
+    monkeypatch.setattr(app_module, 'subdomain_manager', app_module.SubdomainManager(str(tmp_path)))
+    app_module.cache.clear()
+    return app_module.app.test_client()
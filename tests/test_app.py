@@ -0,0 +1,26 @@
+def test_etag_matches_compressed_response(client):
+    """If-None-Match echoing a Flask-Compress ETag ('...:br') yields 304"""
+    for i in range(10):
+        client.post('/api/subdomains', json={'subdomain': f'etag{i}', 'tld': 'com'})
+
+    response = client.get('/api/subdomains', headers={'Accept-Encoding': 'br'})
+    assert response.status_code == 200
+    assert response.headers['Content-Encoding'] == 'br'
+    etag = response.headers['ETag']
+
+    response = client.get('/api/subdomains', headers={
+        'Accept-Encoding': 'br',
+        'If-None-Match': etag
+    })
+    assert response.status_code == 304
+    assert response.data == b''
+
+
+def test_etag_changes_after_write(client):
+    client.post('/api/subdomains', json={'subdomain': 'existing', 'tld': 'com'})
+    etag = client.get('/api/subdomains').headers['ETag']
+
+    client.post('/api/subdomains', json={'subdomain': 'fresh', 'tld': 'com'})
+
+    response = client.get('/api/subdomains', headers={'If-None-Match': etag})
+    assert response.status_code == 200
@@ -0,0 +1,31 @@
+from models import SubdomainManager
+
+
+def test_flush_merges_writes_from_two_workers(tmp_path):
+    """Two managers on one store (as with several gunicorn workers) must not
+    overwrite each other's changes when they flush"""
+    first = SubdomainManager(str(tmp_path))
+    second = SubdomainManager(str(tmp_path))
+
+    assert first.create_subdomain('alpha', 'com', {})
+    assert second.create_subdomain('beta', 'com', {})
+    first.flush()
+    second.flush()
+
+    assert set(SubdomainManager(str(tmp_path)).get_all_subdomains()) == {'alpha.com', 'beta.com'}
+
+    # Each manager picks up the other's record before changing it
+    assert first.update_subdomain('beta', 'com', {'status': 'paused'})
+    assert second.delete_subdomain('alpha', 'com')
+    first.flush()
+    second.flush()
+
+    subdomains = SubdomainManager(str(tmp_path)).get_all_subdomains()
+    assert list(subdomains) == ['beta.com']
+    assert subdomains['beta.com']['status'] == 'paused'
+    assert first.get_stats() == second.get_stats() == {
+        'total_subdomains': 1,
+        'by_tld': {'com': 1},
+        'by_status': {'paused': 1},
+        'ssl_enabled': 1
+    }